@@ -1,9 +1,87 @@
 import torch
-import torch_geometric
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 import scipy
+import hashlib
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+try:
+    import simsimd
+except ImportError:
+    simsimd = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# scipy metrics that have an equivalent SIMD kernel in simsimd.cdist
+SIMSIMD_METRICS = {"euclidean", "sqeuclidean", "cosine"}
+# scipy metrics that can be computed on-device with torch ops
+TORCH_P_NORMS = {"euclidean": 2., "cityblock": 1., "chebyshev": float("inf")}
+TORCH_METRICS = set(TORCH_P_NORMS) | {"sqeuclidean", "cosine"}
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def threshold_condensed_distances(distances, num_nodes, connectivity):
+        """
+        Scores and thresholds condensed distances on the cpu, returns the kept (rows, cols, weights) of the upper triangle.
+        Mirrors the torch code path of EuclideanGraphBuilder.build_edges.
+        """
+        num_pairs = distances.shape[0]
+        max_distance = distances.max()
+        # identical distance features (or nan distances): no score is above the threshold, like in the torch path
+        if not max_distance > 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        scores = np.empty(num_pairs, dtype=np.float64)
+        for i in numba.prange(num_pairs):
+            scores[i] = (max_distance - distances[i]) / max_distance
+        k = int((1 - connectivity) * (num_pairs - 1))
+        quantile = np.partition(scores, k)[k]
+        # count the kept pairs of every row first so that rows can be written independently
+        counts = np.zeros(num_nodes, dtype=np.int64)
+        for row in numba.prange(num_nodes - 1):
+            start = row * num_nodes - row * (row + 1) // 2
+            for offset in range(num_nodes - row - 1):
+                if scores[start + offset] > quantile:
+                    counts[row] += 1
+        positions = np.zeros(num_nodes + 1, dtype=np.int64)
+        positions[1:] = np.cumsum(counts)
+        rows = np.empty(positions[-1], dtype=np.int64)
+        cols = np.empty(positions[-1], dtype=np.int64)
+        weights = np.empty(positions[-1], dtype=np.float32)
+        for row in numba.prange(num_nodes - 1):
+            start = row * num_nodes - row * (row + 1) // 2
+            position = positions[row]
+            for offset in range(num_nodes - row - 1):
+                if scores[start + offset] > quantile:
+                    rows[position] = row
+                    cols[position] = row + offset + 1
+                    weights[position] = scores[start + offset]
+                    position += 1
+        return rows, cols, weights
+
+def condensed_to_square(indeces, num_nodes):
+    """
+    Inverts row-major indeces into the condensed strict upper triangle of a num_nodes x num_nodes matrix.
+    Returns the (rows, cols) with rows < cols, without materializing the indeces of all pairs.
+    """
+    # row i starts at i * (2n - i - 1) / 2, solved for i in float64 and corrected where the sqrt rounded to the
+    # neighbouring row
+    n = num_nodes
+    rows = torch.floor((2 * n - 1 - torch.sqrt((2 * n - 1) ** 2 - 8 * indeces.double())) / 2).long()
+    rows -= (rows * (2 * n - rows - 1) // 2 > indeces).long()
+    rows += ((rows + 1) * (2 * n - rows - 2) // 2 <= indeces).long()
+    cols = indeces - rows * (2 * n - rows - 1) // 2 + rows + 1
+    return rows, cols
 
 class GraphBuilder(ABC, nn.Module):
     def set_encoder(self, encoder: nn.Module):
@@ -14,14 +92,37 @@ class GraphBuilder(ABC, nn.Module):
         pass
 
 class EuclideanGraphBuilder(GraphBuilder):
-    def __init__(self, distance_function, params_indeces, connectivity, edge_level_batch=False):
+    def __init__(self, distance_function, params_indeces, connectivity, edge_level_batch=False, cache_size=0,
+                 half_precision=False, chunk_size=1024):
         super().__init__()
         self.distance_function = distance_function
         self.params_indeces = params_indeces
         self.connectivity = connectivity
         self.edge_level_batch = edge_level_batch
+        # f16 inputs for the simsimd kernels, the distances are only used to rank and weight edges
+        self.half_precision = half_precision
+        # rows per block of the tiled GEMM distances
+        self.chunk_size = chunk_size
+        # LRU cache of the edges of already seen batches, disabled with cache_size=0
+        self.cache_size = cache_size
+        self.edges_cache = OrderedDict()
         if edge_level_batch:
             self.edge_level_params_indeces = params_indeces
+            # the row level batch starts with the distance features of the node
+            self.params_indeces = list(range(len(params_indeces[0][0])))
+            self.distance_features_indeces_1 = torch.tensor(params_indeces[0][0], dtype=torch.long)
+            self.distance_features_indeces_2 = torch.tensor(params_indeces[1][0], dtype=torch.long)
+            self.node_features_indeces_1 = torch.tensor(params_indeces[0][1], dtype=torch.long)
+            self.node_features_indeces_2 = torch.tensor(params_indeces[1][1], dtype=torch.long)
+        # built once and moved to the device lazily instead of being rebuilt from the lists every batch
+        self.distance_features_indeces = torch.tensor(self.params_indeces, dtype=torch.long)
+
+    def get_indeces(self, name, device):
+        indeces = getattr(self, name)
+        if indeces.device != torch.device(device):
+            indeces = indeces.to(device)
+            setattr(self, name, indeces)
+        return indeces
     
     def compute_nodes_matrix(self, batch):
         return self.encoder.get_latent(batch)
@@ -29,37 +130,141 @@ class EuclideanGraphBuilder(GraphBuilder):
     def set_encoder(self, encoder: nn.Module):
         self.encoder = encoder
 
+    def use_torch_distances(self, distance_features):
+        if isinstance(self.distance_function, int):
+            return True
+        if self.distance_function not in TORCH_METRICS:
+            return False
+        # on the cpu the simsimd kernels beat torch.cdist, everywhere else stay on the device
+        return distance_features.is_cuda or simsimd is None or self.distance_function not in SIMSIMD_METRICS
+
+    def compute_condensed_blocks(self, block_function, num_nodes, device):
+        # tiles the upper triangle in blocks of rows, block_function(start, stop) returns the rows start:stop against
+        # the columns start:, so that the working set is chunk_size x num_nodes on top of the condensed output
+        condensed = None
+        position = 0
+        for start in range(0, num_nodes, self.chunk_size):
+            stop = min(start + self.chunk_size, num_nodes)
+            block = block_function(start, stop)
+            if condensed is None:
+                condensed = block.new_empty(num_nodes * (num_nodes - 1) // 2)
+            # the block rows are the first rows of the upper triangle of its width, their pairs are counted in
+            # closed form so that no boolean indexing (and device sync) is needed
+            block_rows, block_width = stop - start, num_nodes - start
+            num_pairs = block_rows * (block_width - 1) - block_rows * (block_rows - 1) // 2
+            rows, cols = condensed_to_square(torch.arange(num_pairs, device=device), block_width)
+            condensed[position:position + num_pairs] = torch.take(block, rows * block_width + cols)
+            position += num_pairs
+        return condensed
+
+    def compute_squared_euclidean_distances(self, distance_features):
+        # ||u - v||^2 = ||u||^2 - 2 u.v + ||v||^2 as a GEMM per block, centering first limits the cancellation error
+        distance_features = distance_features - distance_features.mean(dim=0)
+        squared_norms = distance_features.square().sum(dim=1)
+
+        def block_function(start, stop):
+            block = torch.addmm(squared_norms[None, start:], distance_features[start:stop], distance_features[start:].T,
+                                alpha=-2)
+            return block.add_(squared_norms[start:stop, None])
+
+        return self.compute_condensed_blocks(block_function, distance_features.shape[0],
+                                             distance_features.device).clamp_(min=0.)
+
+    def compute_torch_distances(self, distance_features):
+        if self.distance_function in (2, "euclidean"):
+            return self.compute_squared_euclidean_distances(distance_features).sqrt_()
+        if self.distance_function == "sqeuclidean":
+            return self.compute_squared_euclidean_distances(distance_features)
+        if isinstance(self.distance_function, int):
+            return torch.pdist(distance_features, self.distance_function)
+        if self.distance_function in TORCH_P_NORMS:
+            return torch.pdist(distance_features, TORCH_P_NORMS[self.distance_function])
+        normalized_features = F.normalize(distance_features, dim=1)
+        return 1 - self.compute_condensed_blocks(
+            lambda start, stop: normalized_features[start:stop] @ normalized_features[start:].T, distance_features.shape[0],
+            distance_features.device)
+
+    def compute_cpu_distances(self, distance_features):
+        distance_features = distance_features.detach().cpu()
+        if simsimd is not None and self.distance_function in SIMSIMD_METRICS:
+            torch_dtype, simsimd_dtype = (torch.float16, "f16") if self.half_precision else (torch.float32, "f32")
+            distance_features = distance_features.to(torch_dtype).contiguous().numpy()
+            distances_matrix = simsimd.cdist(distance_features, distance_features, metric=self.distance_function,
+                                             dtype=simsimd_dtype, threads=0)
+            distances_matrix = np.asarray(distances_matrix, dtype=np.float64)
+            distances = scipy.spatial.distance.squareform(distances_matrix, force="tovector", checks=False)
+        else:
+            distance_features = distance_features.numpy()
+            distances = scipy.spatial.distance.pdist(distance_features, self.distance_function)
+        return distances
+
+    def get_cache_key(self, distance_features):
+        data = distance_features.detach().cpu().contiguous().numpy().tobytes()
+        if xxhash is not None:
+            digest = xxhash.xxh3_128_digest(data)
+        else:
+            digest = hashlib.blake2b(data, digest_size=16).digest()
+        return str(distance_features.device), tuple(distance_features.shape), digest
+
     def compute_edges_matrices(self, batch, device):
-        distance_features_indeces = torch.tensor(self.params_indeces, dtype=torch.long, device=device)
+        distance_features_indeces = self.get_indeces("distance_features_indeces", device)
         distance_features = torch.index_select(batch, dim=1, index=distance_features_indeces)
-        if isinstance(self.distance_function, int):
-          distances_matrix = torch.cdist(distance_features, distance_features, self.distance_function)
+        if self.cache_size == 0:
+            return self.build_edges(distance_features, device)
+        # the edges only depend on the distance features, so identical batches share them
+        cache_key = self.get_cache_key(distance_features)
+        if cache_key in self.edges_cache:
+            self.edges_cache.move_to_end(cache_key)
+            return self.edges_cache[cache_key]
+        edges = self.build_edges(distance_features, device)
+        self.edges_cache[cache_key] = edges
+        if len(self.edges_cache) > self.cache_size:
+            self.edges_cache.popitem(last=False)
+        return edges
+
+    def build_edges(self, distance_features, device):
+        # the distance matrix is symmetric with a zero diagonal: only work on the condensed upper triangle
+        num_nodes = distance_features.shape[0]
+        if num_nodes < 2:
+            no_edges = torch.empty(0, dtype=torch.long, device=device)
+            return self.to_undirected_edges(no_edges, no_edges, torch.empty(0, device=device))
+        if self.use_torch_distances(distance_features):
+            # mixed precision training would run the distance GEMMs in half precision
+            with torch.autocast(distance_features.device.type, enabled=False):
+                distances = self.compute_torch_distances(distance_features.float())
         else:
-          distance_features = distance_features.cpu().detach().numpy()
-          distances_matrix = scipy.spatial.distance.cdist(distance_features, distance_features, self.distance_function)
-          distances_matrix = torch.from_numpy(distances_matrix).to(device)
-        min_distance, max_distance = distances_matrix.min(), distances_matrix.max()
-        distances_matrix = (distances_matrix - min_distance) / (max_distance - min_distance)
-        scores_matrix = 1 - distances_matrix
-        scores_matrix = scores_matrix - torch.eye(scores_matrix.shape[0]).to(device)
+            distances = self.compute_cpu_distances(distance_features)
+            if numba is not None:
+                rows, cols, weights = threshold_condensed_distances(distances, num_nodes, self.connectivity)
+                rows, cols, weights = (torch.from_numpy(array).to(device) for array in (rows, cols, weights))
+                return self.to_undirected_edges(rows, cols, weights)
+            # scored in float64 like the distances, float32 would round the closest pairs into ties
+            distances = torch.from_numpy(distances).to(device)
+        # distances normalized by the largest one turned into scores in a single pass, the minimum stays the
+        # zero distance of the (not computed) diagonal as in the dense matrix
+        max_distance = distances.max()
+        # in place, the condensed vectors are the largest tensors of the graph construction
+        scores = distances.neg_().add_(max_distance).div_(max_distance)
         sparsity = 1 - self.connectivity
-        quantile = torch.quantile(scores_matrix, q=sparsity)
-        scores_matrix = torch.where(scores_matrix > quantile, scores_matrix, 0.)
-        edges_indeces, edges_weights = torch_geometric.utils.dense_to_sparse(scores_matrix)
-        return edges_indeces, edges_weights
+        # selection instead of the full sort done by torch.quantile, we only need one order statistic
+        k = int(sparsity * (scores.numel() - 1)) + 1
+        quantile = torch.kthvalue(scores, k).values
+        # emit the COO edges straight from the condensed scores
+        edges = (scores > quantile).nonzero().squeeze(1)
+        rows, cols = condensed_to_square(edges, num_nodes)
+        return self.to_undirected_edges(rows, cols, scores[edges])
 
-    def score_function(self, x):
-        if np.equal(x, 0.) or np.equal(x, np.inf):
-            result = 0.
-        else:
-            result = 1 - x
-        return result
+    def to_undirected_edges(self, rows, cols, weights):
+        # both directions of every kept pair of the upper triangle
+        edges_indeces = torch.stack((torch.cat((rows, cols)), torch.cat((cols, rows))))
+        edges_weights = weights.float().repeat(2)
+        return edges_indeces, edges_weights
 
     def compute_row_level_batch(self, batch, device):
-        distance_features_indeces_1 = torch.tensor(self.edge_level_params_indeces[0][0], dtype=torch.long, device=device)
-        distance_features__indeces_2 = torch.tensor(self.edge_level_params_indeces[1][0], dtype=torch.long, device=device)
-        node_features_indeces_1 = torch.tensor(self.edge_level_params_indeces[0][1], dtype=torch.long, device=device)
-        node_features_indeces_2 = torch.tensor(self.edge_level_params_indeces[1][1], dtype=torch.long, device=device)
+        distance_features_indeces_1 = self.get_indeces("distance_features_indeces_1", device)
+        distance_features__indeces_2 = self.get_indeces("distance_features_indeces_2", device)
+        node_features_indeces_1 = self.get_indeces("node_features_indeces_1", device)
+        node_features_indeces_2 = self.get_indeces("node_features_indeces_2", device)
         distance_features_1 = torch.index_select(batch, dim=1, index=distance_features_indeces_1)
         distance_features_2 = torch.index_select(batch, dim=1, index=distance_features__indeces_2)
         node_features_1 = torch.index_select(batch, dim=1, index=node_features_indeces_1)
@@ -67,7 +272,6 @@ class EuclideanGraphBuilder(GraphBuilder):
         row_level_batch_1 = torch.hstack((distance_features_1, node_features_1))
         row_level_batch_2 = torch.hstack((distance_features_2, node_features_2))
         row_level_batch = torch.vstack((row_level_batch_1, row_level_batch_2))
-        self.params_indeces = list(range(distance_features_indeces_1.shape[0]))
         return row_level_batch
 
     def compute_graph(self, batch, device):
@@ -2,6 +2,7 @@ from sklearn.ensemble import RandomForestRegressor, GradientBoostingRegressor
 from sklearn.multioutput import RegressorChain
 from models import MLP
 from datasets import MultiSplitDataset
+import os
 import time
 import wandb
 
@@ -67,9 +68,12 @@ def MLPRegressor(config: dict[str], dataset_name: str, multisplit_dataset: Multi
         from loader import load_multidatasets
         train_loader, validation_loader, test_loader = load_multidatasets(config, {"dataset": multisplit_dataset})
     else:
-        train_loader = DataLoader(train_dataset, batch_size=batch_size, num_workers=128, shuffle=True)
-        validation_loader = DataLoader(validation_dataset, batch_size=batch_size, num_workers=128, shuffle=False)
-        test_loader = DataLoader(test_dataset, batch_size=batch_size, num_workers=128, shuffle=False)
+        # a few persistent workers keep up with the GPU, more of them only add IPC and respawn overhead
+        loader_kwargs = dict(batch_size=batch_size, num_workers=min(8, os.cpu_count()), persistent_workers=True,
+                             pin_memory=True, prefetch_factor=4)
+        train_loader = DataLoader(train_dataset, shuffle=True, **loader_kwargs)
+        validation_loader = DataLoader(validation_dataset, shuffle=False, **loader_kwargs)
+        test_loader = DataLoader(test_dataset, shuffle=False, **loader_kwargs)
     mlp = MLP(input_dim, [512, 256, 256], label_dim, dropout)
     logger = WandbLogger(save_dir=f"./logs/{dataset_name}/",
                          project="UniversalGNNs",
@@ -78,6 +82,7 @@ def MLPRegressor(config: dict[str], dataset_name: str, multisplit_dataset: Multi
                          mode="online" if log_run else "disabled")
     trainer = pl.Trainer(devices=1,
                          accelerator="gpu",
+                         precision=config["precision"],
                          max_epochs=epochs,
                          log_every_n_steps=100,
                          logger=logger,
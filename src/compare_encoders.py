@@ -1,22 +1,23 @@
 from models import AutoEncoder, VAE
 from datasets import ClimARTDataset, BuildingElectricityDataset
+import os
 import torch
 from torch.utils.data import DataLoader
 
 climart_train = ClimARTDataset(normalize=True)
 BE_train = BuildingElectricityDataset(normalize=True)
 
-climart_loader = DataLoader(climart_train, batch_size=1024, num_workers=64, drop_last=True)
-BE_loader = DataLoader(BE_train, batch_size=1024, num_workers=64, drop_last=True)
+climart_loader = DataLoader(climart_train, batch_size=1024, num_workers=min(8, os.cpu_count()), prefetch_factor=4, drop_last=True)
+BE_loader = DataLoader(BE_train, batch_size=1024, num_workers=min(8, os.cpu_count()), prefetch_factor=4, drop_last=True)
 
 ae_climart = AutoEncoder(climart_train.input_dim, 512)
 ae_climart.load_state_dict(torch.load("checkpoints/encoders/ClimARTDataset/AutoEncoder_512.pt"))
-vae_climart = VAE(climart_train.input_dim, 512, False)
+vae_climart = VAE(climart_train.input_dim, 512)
 vae_climart.load_state_dict(torch.load("checkpoints/encoders/ClimARTDataset/VAE_512.pt"))
 
 ae_BE = AutoEncoder(BE_train.input_dim, 512)
 ae_BE.load_state_dict(torch.load("checkpoints/encoders/BuildingElectricityDataset/AutoEncoder_512.pt"))
-vae_BE = VAE(BE_train.input_dim, 512, False)
+vae_BE = VAE(BE_train.input_dim, 512)
 vae_BE.load_state_dict(torch.load("checkpoints/encoders/BuildingElectricityDataset/VAE_512.pt"))
 
 # how do I pick close points in the input space to check if they are close in the latent space?
@@ -113,7 +113,9 @@ def load_graphbuilders(config: dict[str], datasets: dict[str, MultiSplitDataset]
         graph_builder = graphbuilder_classes[builder_class](distance_function=config["distance_function"],
                                                             params_indeces=splits[0].spatial_temporal_indeces,
                                                             connectivity=config["connectivity"],
-                                                            edge_level_batch=splits[0].edge_level)
+                                                            edge_level_batch=splits[0].edge_level,
+                                                            cache_size=config["cache_size"],
+                                                            half_precision=config["half_precision"])
         for split in splits:
             split.graph_builder = graph_builder
         graphbuilders_dict[dataset_name] = graph_builder
@@ -7,6 +7,17 @@ from GraphBuilder import GraphBuilder
 from abc import ABC, abstractmethod
 
 
+def rename_linear_keys(state_dict, prefix, *args):
+    """
+    Load state dict pre hook for the checkpoints saved before the linear layers were grouped in an nn.Sequential:
+    maps linear1, linear2, linear3 to the positions net.0, net.2, net.4 (the ReLUs sit in between).
+    """
+    for i, name in enumerate(("linear1", "linear2", "linear3")):
+        old_prefix = f"{prefix}{name}."
+        for key in [key for key in state_dict if key.startswith(old_prefix)]:
+            state_dict[f"{prefix}net.{2 * i}.{key[len(old_prefix):]}"] = state_dict.pop(key)
+
+
 class BaseEncoder(ABC, pl.LightningModule):
 
     def __init__(self):
@@ -43,15 +54,13 @@ class Encoder(BaseEncoder):
 
     def __init__(self, input_dim: int, hidden_dim: int, latent_dim: int):
         super().__init__()
-        self.linear1 = nn.Linear(input_dim, hidden_dim)
-        self.linear2 = nn.Linear(hidden_dim, hidden_dim)
-        self.linear3 = nn.Linear(hidden_dim, latent_dim)
+        self.net = nn.Sequential(nn.Linear(input_dim, hidden_dim), nn.ReLU(inplace=True),
+                                 nn.Linear(hidden_dim, hidden_dim), nn.ReLU(inplace=True),
+                                 nn.Linear(hidden_dim, latent_dim), nn.ReLU(inplace=True))
+        self._register_load_state_dict_pre_hook(rename_linear_keys)
 
     def forward(self, x):
-        x = F.relu(self.linear1(x))
-        x = F.relu(self.linear2(x))
-        x = F.relu(self.linear3(x))
-        return x
+        return self.net(x)
     
     def get_latent(self, x):
         return self.forward(x)
@@ -61,15 +70,14 @@ class Decoder(nn.Module):
 
     def __init__(self, latent_dim: int, hidden_dim: int, output_dim: int):
         super().__init__()
-        self.linear1 = nn.Linear(latent_dim, hidden_dim)
-        self.linear2 = nn.Linear(hidden_dim, hidden_dim)
-        self.linear3 = nn.Linear(hidden_dim, output_dim)
+        self.net = nn.Sequential(nn.Linear(latent_dim, hidden_dim), nn.ReLU(inplace=True),
+                                 nn.Linear(hidden_dim, hidden_dim), nn.ReLU(inplace=True),
+                                 nn.Linear(hidden_dim, output_dim))
+        self._register_load_state_dict_pre_hook(rename_linear_keys)
         # self.regr = nn.Linear(output_dim, output_dim)
 
     def forward(self, x):
-        x = F.relu(self.linear1(x))
-        x = F.relu(self.linear2(x))
-        return self.linear3(x)
+        return self.net(x)
 
 class AutoEncoder(BaseEncoder):
 
@@ -80,6 +88,10 @@ class AutoEncoder(BaseEncoder):
         self.hidden_dim = (input_dim + latent_dim) // 2
         self.encoder = Encoder(input_dim, self.hidden_dim, latent_dim)
         self.decoder = Decoder(latent_dim, self.hidden_dim, input_dim)
+        # in-place compilation (torch >= 2.2) does not add an _orig_mod prefix to the state_dict keys
+        if hasattr(nn.Module, "compile"):
+            self.encoder.compile()
+            self.decoder.compile()
 
     def forward(self, x):
         z = self.encoder(x)
@@ -115,38 +127,34 @@ class AutoEncoder(BaseEncoder):
 # for now using an MLP as encoder and decoder
 class VariationalEncoder(BaseEncoder):
 
-    def __init__(self, input_dim: int, hidden_dim: int, latent_dim: int, cuda:bool=True):
+    def __init__(self, input_dim: int, hidden_dim: int, latent_dim: int):
         super().__init__()
-        self.linear1 = nn.Linear(input_dim, hidden_dim)
-        self.linear2 = nn.Linear(hidden_dim, hidden_dim)
+        self.net = nn.Sequential(nn.Linear(input_dim, hidden_dim), nn.ReLU(inplace=True),
+                                 nn.Linear(hidden_dim, hidden_dim), nn.ReLU(inplace=True))
+        # linear_mu and linear_sigma keep their names
+        self._register_load_state_dict_pre_hook(rename_linear_keys)
         self.linear_mu = nn.Linear(hidden_dim, latent_dim)
         self.linear_sigma = nn.Linear(hidden_dim, latent_dim)
-
-        self.N = torch.distributions.Normal(0, 1)
-        # sample on the gpu
-        if cuda:
-            self.N.loc = self.N.loc.cuda()
-            self.N.scale = self.N.scale.cuda()
         self.kl = 0
 
     def forward(self, x):
-        x = F.relu(self.linear1(x))
-        x = F.relu(self.linear2(x))
+        x = self.net(x)
         mu = self.linear_mu(x)
-        sigma = torch.exp(self.linear_sigma(x))
+        log_sigma = self.linear_sigma(x)
+        sigma = torch.exp(log_sigma)
 
-        z = mu + sigma * self.N.sample(mu.shape)
+        # the noise is sampled on the device and with the dtype of mu
+        z = mu + sigma * torch.randn_like(mu)
         # print("mu:", mu)
         # print("sigma:", sigma)
-        self.kl = (sigma**2 + mu**2 - torch.log(sigma) - 1 / 2).mean()
+        self.kl = (sigma**2 + mu**2 - log_sigma - 1 / 2).mean()
         return z
 
     def forward_det(self, x):
         """
         Returns the deterministic mean of the gaussian generated by the sample
         """
-        x = F.relu(self.linear1(x))
-        x = F.relu(self.linear2(x))
+        x = self.net(x)
         mu = self.linear_mu(x)
         return mu
 
@@ -156,13 +164,18 @@ class VariationalEncoder(BaseEncoder):
 
 class VAE(BaseEncoder):
 
-    def __init__(self, input_dim: int, latent_dim: int, cuda: bool=True):
+    def __init__(self, input_dim: int, latent_dim: int):
         super().__init__()
         self.save_hyperparameters()
 
         self.hidden_dim = (input_dim + latent_dim) // 2
-        self.encoder = VariationalEncoder(input_dim, self.hidden_dim, latent_dim, cuda)
+        self.encoder = VariationalEncoder(input_dim, self.hidden_dim, latent_dim)
         self.decoder = Decoder(latent_dim, self.hidden_dim, input_dim)
+        if hasattr(nn.Module, "compile"):
+            self.encoder.compile()
+            self.decoder.compile()
+            # get_latent bypasses the compiled __call__ of the encoder, compile the deterministic path separately
+            self.encoder.forward_det = torch.compile(self.encoder.forward_det)
 
     def forward(self, x):
         z = self.encoder(x)
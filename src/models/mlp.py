@@ -27,6 +27,8 @@ class MLP(pl.LightningModule):
 
         self.output_layer = nn.Linear(hidden_sizes[-1], output_size)
         self.relu = nn.ReLU()
+        if hasattr(nn.Module, "compile"):
+            self.compile()
 
     def forward(self, x):
         x = self.relu(self.dropout(self.layer_norm(self.input_layer(x))))
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 from torch_geometric.nn import GCNConv, DeepGCNLayer, LayerNorm, Sequential
+from torch_sparse import SparseTensor
 import torch.nn.functional as F
 import pytorch_lightning as pl
 from torch.optim import Adam
@@ -25,16 +26,22 @@ class GNN(nn.Module):
         for i in range(n_layers - 2):
             conv = GCNConv(hidden_channels, hidden_channels)
             norm = LayerNorm(hidden_channels)
-            deeplayers_list.append((DeepGCNLayer(conv, norm, self.act), 'x, edge_index, edge_weight -> x'))
-        self.hidden_deeplayers = Sequential('x, edge_index, edge_weight', deeplayers_list)
+            deeplayers_list.append((DeepGCNLayer(conv, norm, self.act), 'x, adj_t -> x'))
+        self.hidden_deeplayers = Sequential('x, adj_t', deeplayers_list)
         self.out_deeplayer = DeepGCNLayer(self.out_conv, self.out_norm, nn.Identity())
 
     def forward(self, node_matrix: torch.Tensor, edge_index: torch.Tensor, edge_weights) -> torch.Tensor:
         # x: Node feature matrix of shape [num_nodes, in_channels]
         # edge_index: Graph connectivity matrix of shape [2, num_edges]
-        x = self.in_deeplayer(node_matrix, edge_index, edge_weights)
-        x = self.hidden_deeplayers(x, edge_index, edge_weights)
-        x = self.out_deeplayer(x.float(), edge_index, edge_weights)
+        num_nodes = node_matrix.shape[0]
+        # GCNConv takes the transposed adjacency, stored compressed by row instead of scattering over COO edges
+        adj_t = SparseTensor(row=edge_index[1], col=edge_index[0], value=edge_weights.float(),
+                             sparse_sizes=(num_nodes, num_nodes))
+        # the sparse matmul kernels need the node features and the edge weights in the same dtype
+        with torch.autocast(node_matrix.device.type, enabled=False):
+            x = self.in_deeplayer(node_matrix.float(), adj_t)
+            x = self.hidden_deeplayers(x, adj_t)
+            x = self.out_deeplayer(x.float(), adj_t)
         return x.float()
 
 
@@ -61,6 +61,7 @@ def train_autoencoder(config: dict, autoencoder: nn.Module, train_dataset: Check
                          mode="online" if log_run else "disabled")
     trainer = pl.Trainer(devices=1,
                          accelerator="gpu",
+                         precision=config["precision"],
                          max_epochs=config["max_epochs"],
                          log_every_n_steps=10,
                          logger=logger,
@@ -102,7 +103,7 @@ def train_single(config_all: dict[str], datasets: dict[str, MultiSplitDataset],
             from loader import load_multidatasets
             print(f"Training UniversalGNN single on {dataset_name} using random sampler!")
             train_loader, val_loader, test_loader = load_multidatasets(config, datasets={dataset_name: dataset})
-            trainer = pl.Trainer(devices=1, accelerator="gpu", max_epochs=config["epochs"], log_every_n_steps=50, logger=logger)
+            trainer = pl.Trainer(devices=1, accelerator="gpu", precision=config["precision"], max_epochs=config["epochs"], log_every_n_steps=50, logger=logger)
         else:
             print(f"Training UniversalGNN single on {dataset_name} using standard data loader!")
             train_split, validation_split, test_split = dataset.get_splits()
@@ -111,6 +112,7 @@ def train_single(config_all: dict[str], datasets: dict[str, MultiSplitDataset],
             test_loader = DataLoader(test_split, batch_size=config["batch_size"], shuffle=False, num_workers=0)
             trainer = pl.Trainer(devices=1,
                                  accelerator="gpu",
+                                 precision=config["precision"],
                                  max_epochs=config["epochs"],
                                  max_steps=config["max_steps"],
                                  log_every_n_steps=50,
@@ -144,6 +146,7 @@ def train_mutual(config_all: dict[dict[str]], loaders: tuple[DataLoader, DataLoa
                          mode="online" if log_run else "disabled")
     trainer = pl.Trainer(devices=1,
                          accelerator="gpu",
+                         precision=config["precision"],
                          max_epochs=config["epochs"],
                          log_every_n_steps=50,
                          logger=logger,